@@ -3,9 +3,20 @@ import asyncio
 import sys
 from pathlib import Path
 
+from bl.console import install_warning_handler
 from bl.spec_parser import load_spec_file
-from bl.spec_processor import process_project
-from bl.freezer import freeze_project
+
+try:
+    # libuv based loop, cheaper subprocess and pipe handling than the default one
+    from uvloop import new_event_loop
+except ImportError:
+    new_event_loop = None
+
+
+def run_async(coroutine):
+    """Runs coroutine on uvloop when it is installed, on the default asyncio loop otherwise."""
+    with asyncio.Runner(loop_factory=new_event_loop) as runner:
+        return runner.run(coroutine)
 
 
 def run():
@@ -13,25 +24,65 @@ def run():
         description="Process a project specification.", formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument(
-        "-f", "--freeze", const=True, default=None, nargs="?", type=Path, help="Freeze the current state of modules"
+        "-f",
+        "--freeze",
+        const=True,
+        default=None,
+        nargs="?",
+        type=Path,
+        help="Freeze the current state of modules, into frozen.yaml by default, with a .json cache next to it.",
     )
     parser.add_argument(
         "-c", "--config", type=Path, help="Path to the project specification file.", default="spec.yaml"
     )
     parser.add_argument("-z", "--frozen", type=Path, help="Path to the frozen specification file.")
-    parser.add_argument("-j", "--concurrency", type=int, default=28, help="Number of concurrent tasks.")
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=28,
+        help="Number of modules processed at once, also the cap on network and on local git processes.",
+    )
     parser.add_argument("-w", "--workdir", type=Path, help="Working directory. Defaults to config directory.")
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="Directory where local mirrors of the remotes are kept to speed up new clones. Disabled if not set.",
+    )
+    parser.add_argument(
+        "--per-host-concurrency",
+        type=int,
+        help="Maximum number of clones and fetches running against the same host. Not limited if not set.",
+    )
+    parser.add_argument(
+        "-x", "--fail-fast", action="store_true", help="Stop processing the other modules as soon as one fails."
+    )
     args = parser.parse_args()
 
+    # Before loading the spec, whose parser warns about deprecated formats
+    install_warning_handler()
     project_spec = load_spec_file(args.config, args.frozen, args.workdir)
     if project_spec is None:
         sys.exit(1)
 
     try:
+        # Only import the code path we need, they each pull their own dependencies
         if args.freeze:
-            asyncio.run(freeze_project(project_spec, args.freeze, concurrency=args.concurrency))
+            from bl.freezer import freeze_project
+
+            run_async(freeze_project(project_spec, args.freeze, concurrency=args.concurrency))
         else:
-            asyncio.run(process_project(project_spec, concurrency=args.concurrency))
+            from bl.spec_processor import process_project
+
+            run_async(
+                process_project(
+                    project_spec,
+                    concurrency=args.concurrency,
+                    cache_dir=args.cache_dir,
+                    fail_fast=args.fail_fast,
+                    per_host_concurrency=args.per_host_concurrency,
+                )
+            )
     except Exception:
         sys.exit(1)
 
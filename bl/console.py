@@ -0,0 +1,15 @@
+import warnings
+
+from rich.console import Console
+
+console = Console()
+
+
+def rich_warning(message, category, filename, lineno, file=None, line=None):
+    console.print(f"[yellow]Warning:[/] {category.__name__}: {message}\n[dim]{filename}:{lineno}[/]")
+
+
+def install_warning_handler():
+    """Prints warnings through rich, deprecations included, which Python hides by default."""
+    warnings.showwarning = rich_warning
+    warnings.simplefilter("default", DeprecationWarning)
@@ -1,46 +1,94 @@
 import asyncio
+import json
 import yaml
-from operator import countOf
 from pathlib import Path
-from typing import TextIO
+from typing import List, Tuple
 
 from rich.console import Console
 from rich.live import Live
 from rich.progress import BarColumn, MofNCompleteColumn, Progress, TaskID, TextColumn
-from bl.spec_parser import ModuleSpec, ProjectSpec
-from bl.utils import get_local_ref, get_module_path, run_git
+from bl.spec_parser import (
+    FROZEN_SIDECAR_VERSION,
+    ModuleSpec,
+    ProjectSpec,
+    get_frozen_digest,
+    get_frozen_sidecar_path,
+)
+from bl.utils import DynamicLimiter, get_module_path, run_git, run_git_batch_check, set_git_concurrency
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper  # type: ignore[assignment]
 
 console = Console()
 
 
+def get_freeze_ref_entries(module_spec: ModuleSpec) -> List[Tuple[str, str, str]]:
+    """Returns the (local_ref, ref_name, remote) tuple of each ref to freeze in a module."""
+    return [
+        (refspec_info.local_ref, refspec_info.ref_name or refspec_info.refspec, refspec_info.remote)
+        for refspec_info in module_spec.refspec_info
+    ]
+
+
 async def freeze_spec(
-    sem: asyncio.Semaphore,
+    limiter: DynamicLimiter,
     progress: Progress,
     task_id: TaskID,
     module_name: str,
-    module_spec: ModuleSpec,
-    workdir: Path,
+    module_path: Path,
+    ref_entries: List[Tuple[str, str, str]],
 ):
-    result = {module_name: {}}
-    async with sem:
-        module_path = get_module_path(workdir, module_name, module_spec)
+    """
+    Resolves the current sha of each ref of a module.
 
-        for refspec_info in module_spec.refspec_info:
-            local_ref = get_local_ref(refspec_info)
-            ret, out, err = await run_git("rev-list", "--max-count", "1", local_ref, cwd=module_path)
+    ref_entries holds (local_ref, ref_name, remote) tuples, see get_freeze_ref_entries.
+    """
+    module_result = {}
+    result = {module_name: module_result}
+    async with limiter:
+        shas = await run_git_batch_check([local_ref for local_ref, _, _ in ref_entries], cwd=module_path)
 
-            ref_name = refspec_info.ref_name or refspec_info.refspec
+        # cat-file could not resolve some refs, let rev-list have a go at them concurrently
+        missing = [index for index, sha in enumerate(shas) if sha is None]
+        if missing:
+            outs = await asyncio.gather(
+                *(run_git("rev-list", "--max-count", "1", ref_entries[index][0], cwd=module_path) for index in missing)
+            )
+            for index, (ret, out, err) in zip(missing, outs):
+                shas[index] = out
 
-            data = result[module_name].get(refspec_info.remote, {})
-            data[ref_name] = out
-            result[module_name][refspec_info.remote] = data
+        for (local_ref, ref_name, remote), sha in zip(ref_entries, shas):
+            module_result.setdefault(remote, {})[ref_name] = sha
         progress.advance(task_id)
 
     return result
 
 
+async def freeze_spec_into(freeze_data: dict, *args) -> None:
+    """Runs freeze_spec and stores its result directly into freeze_data."""
+    freeze_data.update(await freeze_spec(*args))
+
+
+def write_freeze_files(freeze_data: dict, freeze_file_path: Path) -> None:
+    """Writes the frozen YAML file and its JSON sidecar."""
+    freeze_content = yaml.dump(freeze_data, Dumper=SafeDumper, default_flow_style=False).encode()
+    freeze_file_path.write_bytes(freeze_content)
+    with open(get_frozen_sidecar_path(freeze_file_path), "w") as sidecar_stream:
+        json.dump(
+            {
+                "version": FROZEN_SIDECAR_VERSION,
+                "yaml_digest": get_frozen_digest(freeze_content),
+                "frozen": freeze_data,
+            },
+            sidecar_stream,
+        )
+
+
 async def freeze_project(project_spec: ProjectSpec, freeze_file: Path | bool, concurrency: int):
-    frz_semaphore = asyncio.Semaphore(concurrency)
+    limiter = DynamicLimiter(concurrency)
+    await set_git_concurrency(concurrency)
     workdir = project_spec.workdir
     freeze_file_name = freeze_file if freeze_file is not True else "frozen.yaml"
     freeze_file_path = workdir / freeze_file_name
@@ -56,25 +104,22 @@ async def freeze_project(project_spec: ProjectSpec, freeze_file: Path | bool, co
 
     freeze_data = {}
 
-    with Live(task_count_progress, console=console, refresh_per_second=10):
-        task_list = []
-        for name, spec in project_spec.specs.items():
-            task_list.append(
-                freeze_spec(
-                    frz_semaphore,
-                    task_count_progress,
-                    count_task,
-                    name,
-                    spec,
-                    workdir,
+    with Live(task_count_progress, console=console, refresh_per_second=4, auto_refresh=console.is_terminal):
+        async with asyncio.TaskGroup() as task_group:
+            for name, spec in project_spec.specs.items():
+                task_group.create_task(
+                    freeze_spec_into(
+                        freeze_data,
+                        limiter,
+                        task_count_progress,
+                        count_task,
+                        name,
+                        get_module_path(workdir, name, spec),
+                        get_freeze_ref_entries(spec),
+                    )
                 )
-            )
-        freeze_list = await asyncio.gather(*task_list)
-        for item in freeze_list:
-            freeze_data.update(item)
 
-    console.print(yaml.dump(freeze_data, default_flow_style=False))
-    with open(freeze_file_path, "w") as freeze_stream:
-        yaml.dump(freeze_data, freeze_stream, default_flow_style=False)
+    await asyncio.to_thread(write_freeze_files, freeze_data, freeze_file_path)
+    console.print(f"Wrote {len(freeze_data)} modules to {freeze_file_path}")
 
     return 0
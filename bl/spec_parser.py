@@ -1,13 +1,34 @@
-import re
+import copy
+import functools
+import hashlib
+import os
 import warnings
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from enum import Enum
+from itertools import chain
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore[assignment]
 
-class OriginType(Enum):
+    warnings.warn(
+        "PyYAML is built without libyaml, spec parsing will use the slow pure Python loader.",
+        RuntimeWarning,
+    )
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore[assignment]
+
+
+class OriginType(str, Enum):
     """Type of origin reference."""
 
     BRANCH = "branch"
@@ -15,20 +36,25 @@ class OriginType(Enum):
     REF = "ref"
 
 
-def make_remote_merge_from_src(src: str) -> tuple[dict, list]:
-    """
-    Creates a remote and merge entry from the src string.
-    """
-    remotes = {}
-    merges = []
+_HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def _is_pr_ref(origin_value: str) -> bool:
+    """Matches GitHub PR references: refs/pull/{pr_id}/head"""
+    return (
+        len(origin_value) > 15
+        and origin_value.startswith("refs/pull/")
+        and origin_value.endswith("/head")
+        and origin_value[10:-5].isdecimal()
+    )
 
-    parts = src.split(" ", 1)
-    remotes["origin"] = parts[0]
-    merges.append(f"origin {parts[1]}")
 
-    return remotes, merges
+def _is_sha(origin_value: str) -> bool:
+    """Matches git reference hashes (40 hex characters)"""
+    return len(origin_value) == 40 and not set(origin_value) - _HEX_DIGITS
 
 
+@functools.lru_cache(maxsize=1024)
 def get_origin_type(origin_value: str) -> OriginType:
     """
     Determines the origin type based on the origin value.
@@ -39,73 +65,204 @@ def get_origin_type(origin_value: str) -> OriginType:
     Returns:
         The corresponding OriginType.
     """
-    # Pattern to match GitHub PR references: refs/pull/{pr_id}/head
-    pr_pattern = re.compile(r"^refs/pull/\d+/head$")
-    # Pattern to match that matches git reference hashes (40 hex characters)
-    ref_pattern = re.compile(r"^[a-z0-9]{40}$")
-
-    if pr_pattern.match(origin_value):
+    if _is_pr_ref(origin_value):
         return OriginType.PR
-    elif ref_pattern.match(origin_value):
+    elif _is_sha(origin_value):
         return OriginType.REF
     else:
         return OriginType.BRANCH
 
 
+@dataclass(slots=True, frozen=True)
 class RefspecInfo:
     """A git refspec with its remote, type and optional frozen sha."""
 
-    def __init__(
-        self,
-        remote: str,
-        ref_str: str,
-        type: OriginType,
-        ref_name: Optional[str],
-    ):
-        self.remote = remote
-        self.refspec = ref_str
-        """ The refspec string (branch name, PR ref, or commit hash). """
-        self.type = type
-        self.ref_name = ref_name
+    remote: str
+    refspec: str
+    """ The refspec string (branch name, PR ref, or commit hash). """
+    type: OriginType
+    ref_name: Optional[str] = None
+    local_ref: str = field(init=False, repr=False, compare=False)
+    """ The local branch the ref is fetched into, computed once since every step of a build uses it. """
 
-    def __repr__(self) -> str:
-        return f"RefspecInfo(remote={self.remote!r}, origin={self.refspec!r}, type={self.type.value})"
+    def __post_init__(self):
+        object.__setattr__(self, "local_ref", f"loc-{self.ref_name or self.refspec}")
 
 
+@dataclass(slots=True)
 class ModuleSpec:
     """Represents the specification for a set of modules."""
 
-    def __init__(
-        self,
-        modules: List[str],
-        remotes: Optional[Dict[str, str]] = {},
-        origins: Optional[List[RefspecInfo]] = [],
-        shell_commands: Optional[List[str]] = [],
-        patch_globs_to_apply: Optional[List[str]] = None,
-        target_folder: Optional[str] = None,
-        frozen_modules: Optional[Dict[str, Dict[str, str]]] = None,
-    ):
-        self.modules = modules
-        self.remotes = remotes
-        self.refspec_info = origins
-        self.shell_commands = shell_commands
-        self.patch_globs_to_apply = patch_globs_to_apply
-        self.frozen_modules = frozen_modules
-        self.target_folder = None
-
-    def __repr__(self) -> str:
-        return f"ModuleSpec(modules={self.modules}, remotes={self.remotes}, origins={self.refspec_info})"
+    modules: List[str]
+    remotes: Dict[str, str] = field(default_factory=dict)
+    refspec_info: List[RefspecInfo] = field(default_factory=list)
+    shell_commands: Optional[List[str]] = None
+    patch_globs_to_apply: Optional[List[str]] = None
+    target_folder: Optional[str] = None
+    frozen_modules: Optional[Dict[str, Dict[str, str]]] = None
 
 
+@dataclass(slots=True)
 class ProjectSpec:
     """Represents the overall project specification from the YAML file."""
 
-    def __init__(self, specs: Dict[str, ModuleSpec], workdir: Path = Path(".")):
-        self.specs = specs
-        self.workdir = workdir
+    specs: Dict[str, ModuleSpec]
+    workdir: Path = Path(".")
+
+
+_YAML_CACHE_SIZE = 100
+_yaml_cache: "OrderedDict[tuple[str, int, bytes], Any]" = OrderedDict()
+
+
+def _stat_if_exists(path: Path) -> Optional[os.stat_result]:
+    """Returns the stat of path, or None if it does not exist."""
+    try:
+        return os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _load_yaml_cached(path: Path, content: Optional[bytes] = None) -> Any:
+    """
+    Loads a YAML file, reusing the parsed document if the file did not change.
+
+    The cache is keyed on (absolute path, size, content hash) rather than mtime, which
+    is not reliable once files are copied around by deploys. A deep copy is returned
+    on hit because callers mutate the parsed data (remotes, merges). content can be
+    passed when the caller already read the file.
+    """
+    if content is None:
+        content = path.read_bytes()
+    digest = hashlib.blake2b(content, digest_size=8).digest()
+    key = (os.path.abspath(path), len(content), digest)
+    cached = _yaml_cache.get(key)
+    if cached is not None:
+        _yaml_cache.move_to_end(key)
+        return copy.deepcopy(cached)
+
+    data = yaml.load(content, Loader=SafeLoader)
+
+    _yaml_cache[key] = data
+    if len(_yaml_cache) > _YAML_CACHE_SIZE:
+        _yaml_cache.popitem(last=False)
+    return copy.deepcopy(data)
+
+
+# Bump when the layout of the frozen sidecar changes so stale sidecars are ignored
+FROZEN_SIDECAR_VERSION = 2
+
+
+def get_frozen_sidecar_path(frozen_path: Path) -> Path:
+    """Returns the path of the JSON sidecar written next to a frozen YAML file."""
+    return frozen_path.with_suffix(".json")
+
 
-    def __repr__(self) -> str:
-        return f"ProjectSpec(specs={self.specs}, workdir={self.workdir})"
+def get_frozen_digest(frozen_content: bytes) -> str:
+    """Returns the digest of a frozen YAML file, recorded in its sidecar."""
+    return hashlib.blake2b(frozen_content, digest_size=16).hexdigest()
+
+
+def _load_frozen_sidecar(frozen_path: Path, frozen_content: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Loads the JSON copy of the frozen mapping written by the freezer.
+
+    JSON parses much faster than YAML. The sidecar records the digest of the YAML file
+    it was written with and is only used while the YAML file still has that content, so
+    hand edits of the YAML file always win whatever the file times say.
+    """
+    try:
+        sidecar = json_loads(get_frozen_sidecar_path(frozen_path).read_bytes())
+    except FileNotFoundError:
+        return None
+    except ValueError:  # both json and orjson decode errors are ValueError
+        return None
+
+    if (
+        not isinstance(sidecar, dict)
+        or sidecar.get("version") != FROZEN_SIDECAR_VERSION
+        or sidecar.get("yaml_digest") != get_frozen_digest(frozen_content)
+    ):
+        return None
+    frozen = sidecar.get("frozen")
+    return frozen if isinstance(frozen, dict) else None
+
+
+_deprecated_src_format_warned = False
+
+
+def _warn_deprecated_src_format() -> None:
+    """Warns about the 3 parts merge format, once per process."""
+    global _deprecated_src_format_warned
+    if not _deprecated_src_format_warned:
+        _deprecated_src_format_warned = True
+        warnings.warn(
+            "Deprecated src format: use <url> <sha> format for the src property",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+
+
+# Shared empty mapping for frozen lookups misses, never mutated
+_EMPTY_FREEZES: Dict[str, Any] = {}
+
+
+def _build_module_spec(section_data: Dict[str, Any], frozen_for_section: Any) -> ModuleSpec:
+    """
+    Builds the ModuleSpec of one spec.yaml section.
+
+    Args:
+        section_data: The parsed section of the spec file.
+        frozen_for_section: The frozen.yaml entry of the section, ignored if it is not a mapping.
+    """
+    if not isinstance(frozen_for_section, dict):
+        frozen_for_section = _EMPTY_FREEZES
+
+    src = section_data.get("src")
+    remotes = section_data.get("remotes") or {}
+    merges = section_data.get("merges") or []
+
+    if src:
+        # If src is defined, it is the "origin" remote and its ref is merged first
+        src_url, src_ref = src.split(" ", 1)
+        remotes["origin"] = src_url
+        merges = chain((f"origin {src_ref}",), merges)
+
+    # Parse merges into RefspecInfo objects
+    origins: List[RefspecInfo] = []
+    for merge_entry in merges:
+        # Same as merge_entry.split(" ", 2) without building the list
+        first_space = merge_entry.find(" ")
+        if first_space < 0:
+            continue
+        remote_key = merge_entry[:first_space]
+        second_space = merge_entry.find(" ", first_space + 1)
+        if second_space < 0:
+            ref_spec = merge_entry[first_space + 1 :]
+        else:
+            _warn_deprecated_src_format()
+            ref_spec = merge_entry[second_space + 1 :]
+
+        frozen_sha = (frozen_for_section.get(remote_key) or _EMPTY_FREEZES).get(ref_spec)
+        if frozen_sha:
+            # A frozen sha overrides the ref, no need to guess its type
+            ref_name = ref_spec
+            ref_type = OriginType.REF
+            ref_spec = frozen_sha
+        else:
+            # Determine type: PR if matches refs/pull/{pr_id}/head pattern, otherwise branch
+            ref_name = None
+            ref_type = get_origin_type(ref_spec)
+
+        origins.append(RefspecInfo(remote_key, ref_spec, ref_type, ref_name))
+
+    return ModuleSpec(
+        section_data.get("modules", []),
+        remotes,
+        origins,
+        section_data.get("shell_command_after") or None,
+        section_data.get("patch_globs") or None,
+        frozen_modules=frozen_for_section or None,
+    )
 
 
 def load_spec_file(config: Path, frozen: Path, workdir: Path) -> Optional[ProjectSpec]:
@@ -118,12 +275,14 @@ def load_spec_file(config: Path, frozen: Path, workdir: Path) -> Optional[Projec
     Returns:
         A ProjectSpec object if successful, None otherwise.
     """
-    if not config.exists():
+    config_stat = _stat_if_exists(config)
+    if config_stat is None:
         if config.is_relative_to("."):
             config = config.resolve()
             # If the file is not in the current directory, check inside the odoo subdirectory
             odoo_config = config.parent / "odoo" / config.name
-            if not odoo_config.exists():
+            config_stat = _stat_if_exists(odoo_config)
+            if config_stat is None:
                 print(f"Error: Neither '{config}' nor '{odoo_config}' exists.")
                 return None
             config = odoo_config
@@ -133,93 +292,33 @@ def load_spec_file(config: Path, frozen: Path, workdir: Path) -> Optional[Projec
 
     workdir = workdir or config.parent
 
-    with config.open("r") as f:
-        try:
-            data: Dict[str, Any] = yaml.safe_load(f)
-        except yaml.YAMLError as e:
-            print(f"Error parsing YAML file '{config}': {e}")
-            return None
+    try:
+        data: Dict[str, Any] = _load_yaml_cached(config)
+    except yaml.YAMLError as e:
+        print(f"Error parsing YAML file '{config}': {e}")
+        return None
 
     frozen_mapping: Dict[str, Dict[str, Dict[str, str]]] = {}
-    frozen_path = frozen or Path(config).with_name("frozen.yaml")
-    if frozen_path.exists():
-        try:
-            with frozen_path.open("r") as frozen_file:
-                loaded_freezes = yaml.safe_load(frozen_file) or {}
+    frozen_path = frozen or config.with_name("frozen.yaml")
+    try:
+        frozen_content = frozen_path.read_bytes()
+    except (FileNotFoundError, NotADirectoryError):
+        frozen_content = None
+    if frozen_content is not None:
+        sidecar_freezes = _load_frozen_sidecar(frozen_path, frozen_content)
+        if sidecar_freezes is not None:
+            frozen_mapping = sidecar_freezes
+        else:
+            try:
+                loaded_freezes = _load_yaml_cached(frozen_path, frozen_content) or {}
                 if isinstance(loaded_freezes, dict):
                     frozen_mapping = loaded_freezes
-        except yaml.YAMLError as e:
-            print(f"Error parsing frozen YAML file '{frozen_path}': {e}")
-
-    specs: Dict[str, ModuleSpec] = {}
-    for section_name, section_data in data.items():
-        modules = section_data.get("modules", [])
-        src = section_data.get("src")
-        remotes = section_data.get("remotes") or {}
-        merges = section_data.get("merges") or []
-        shell_commands = section_data.get("shell_command_after") or None
-        patch_globs_to_apply = section_data.get("patch_globs") or None
-
-        frozen_for_section_raw = frozen_mapping.get(section_name)
-        frozen_for_section: Optional[Dict[str, Dict[str, str]]] = (
-            frozen_for_section_raw if isinstance(frozen_for_section_raw, dict) else None
-        )
+            except yaml.YAMLError as e:
+                print(f"Error parsing frozen YAML file '{frozen_path}': {e}")
 
-        # Parse merges into RefspecInfo objects
-        origins: List[RefspecInfo] = []
-        if src:
-            # If src is defined, create a remote and merge entry from it
-            src_remotes, src_merges = make_remote_merge_from_src(src)
-            remotes.update(src_remotes)
-            merges = src_merges + merges
-
-        for merge_entry in merges:
-            parts = merge_entry.split(" ", 2)
-            if len(parts) == 2:
-                remote_key, ref_spec = parts
-
-                # Determine type: PR if matches refs/pull/{pr_id}/head pattern, otherwise branch
-                ref_type = get_origin_type(ref_spec)
-
-                ref_name = None
-                if frozen_for_section:
-                    remote_freezes = frozen_for_section.get(remote_key) or {}
-                    ref_name = ref_spec
-                    ref_type = OriginType.REF
-                    frozen_ref = remote_freezes.get(ref_spec)
-                    ref_spec = frozen_ref or ref_spec
-
-                origins.append(
-                    RefspecInfo(
-                        remote_key,
-                        ref_spec,
-                        ref_type,
-                        ref_name,
-                    )
-                )
-            elif len(parts) == 3:
-                warnings.warn(
-                    "Deprecated src format: use <url> <sha> format for the src property",
-                    DeprecationWarning,
-                )
-                remote_key, _, ref_spec = parts
-                ref_type = get_origin_type(ref_spec)
-
-                ref_name = None
-                if frozen_for_section:
-                    remote_freezes = frozen_for_section.get(remote_key) or {}
-                    ref_name = ref_spec
-                    ref_spec = remote_freezes.get(ref_spec)
-
-                origins.append(RefspecInfo(remote_key, ref_spec, ref_type, ref_name))
-
-        specs[section_name] = ModuleSpec(
-            modules,
-            remotes,
-            origins,
-            shell_commands,
-            patch_globs_to_apply,
-            frozen_modules=frozen_for_section or None,
-        )
+    specs: Dict[str, ModuleSpec] = {
+        section_name: _build_module_spec(section_data, frozen_mapping.get(section_name))
+        for section_name, section_data in data.items()
+    }
 
     return ProjectSpec(specs, workdir)
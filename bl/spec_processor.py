@@ -1,50 +1,63 @@
 import asyncio
+import contextlib
+import fcntl
+import glob
 import hashlib
-from logging import root
 import os
-from posix import link
-import warnings
 import shutil
+from collections import defaultdict
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Dict, List, Optional, Set
 
-from rich.console import Console
 from rich.live import Live
 from rich.progress import BarColumn, MofNCompleteColumn, Progress, SpinnerColumn, TaskID, TextColumn
 from rich.table import Column, Table
 from typing_extensions import deprecated
 
-from bl.utils import english_env, get_local_ref, get_module_path, run_git
+from bl.console import console, install_warning_handler
+from bl.utils import (
+    DynamicLimiter,
+    english_env,
+    get_module_path,
+    get_remote_host,
+    is_shallow_repository,
+    normalize_remote_url,
+    read_stream_tail,
+    run_git,
+    run_git_batch,
+    run_git_batch_check,
+    set_git_concurrency,
+)
 
 from .spec_parser import ModuleSpec, OriginType, ProjectSpec, RefspecInfo
 
-console = Console()
-
-
-def rich_warning(message, category, filename, lineno, file=None, line=None):
-    console.print(f"[yellow]Warning:[/] {category.__name__}: {message}\n[dim]{filename}:{lineno}[/]")
-
-
-warnings.showwarning = rich_warning
-warnings.simplefilter("default", DeprecationWarning)
+install_warning_handler()
 
 
 # for single branch we should clone shallow but for other we should clone
 # with tree:0 filter and because this avoid confusing fetch for git to have the history
 # before fetching
-def create_clone_args(name: str, ref_spec_info: RefspecInfo, remote_url: str, shallow: bool) -> List[str]:
+def create_clone_args(
+    name: str, ref_spec_info: RefspecInfo, remote_url: str, shallow: bool, no_checkout: bool = False
+) -> List[str]:
     """Creates git clone arguments based on the base origin."""
     args = [
         "clone",
         "--filter=tree:0",
     ]
 
+    if no_checkout:
+        args += ["--no-checkout"]
+
     if name == "odoo" or shallow:
         args += [
             "--depth",
             "1",
         ]
-    else:
+
+    if name != "odoo":
+        # Only check out the root files, the modules are added by sparse-checkout
+        # afterwards instead of checking out the whole tree and then trimming it
         args += ["--sparse"]
 
     if ref_spec_info.type == OriginType.REF:
@@ -67,22 +80,194 @@ def create_clone_args(name: str, ref_spec_info: RefspecInfo, remote_url: str, sh
     return args
 
 
-def normalize_merge_result(ret: int, out: str, err: str):
-    if "CONFLICT" in out:
+def create_cone_sparse_patterns(directories: List[str]) -> bytes:
+    """
+    Builds the content of a cone mode sparse-checkout file including directories.
+
+    This is what `git sparse-checkout set` writes: the root files, every listed
+    directory and, for nested ones, their parents without the parents' other children.
+    """
+    leaves = {directory.strip("/") for directory in directories} - {""}
+    parents = {leaf.rsplit("/", depth)[0] for leaf in leaves for depth in range(1, leaf.count("/") + 1)}
+
+    patterns = ["/*", "!/*/"]
+    for path in sorted(leaves | parents):
+        # Everything under an included directory is already checked out
+        if any(path.startswith(f"{leaf}/") for leaf in leaves):
+            continue
+        patterns.append(f"/{path}/")
+        if path not in leaves:
+            patterns.append(f"!/{path}/*/")
+    return "\n".join(patterns).encode() + b"\n"
+
+
+def expand_patch_globs(patterns: List[str], module_path: Path) -> List[str]:
+    """
+    Expands patch_globs from the module directory like a shell would: each pattern
+    in sorted order, kept as is when it matches nothing.
+    """
+    patch_files = []
+    for pattern in patterns:
+        patch_files += sorted(glob.glob(pattern, root_dir=module_path)) or [pattern]
+    return patch_files
+
+
+def normalize_merge_result(ret: int, out: str, err: str, module_path: Path):
+    """
+    Turns a failed merge that stopped on conflicts into (-1, conflict messages).
+
+    A merge that stopped on conflicts leaves MERGE_HEAD behind, other failures
+    (unknown ref, dirty tree...) do not, which does not depend on parsing git output.
+    """
+    if ret != 0 and (module_path / ".git" / "MERGE_HEAD").exists():
         return -1, out
 
     return ret, err
 
 
+SHELL_METACHARACTERS = frozenset("|&;<>()$`\\\"'*?[]#~={}!\n")
+
+
+def needs_shell(cmd: str) -> bool:
+    """Tells whether cmd uses shell syntax and must be run through a shell."""
+    return not SHELL_METACHARACTERS.isdisjoint(cmd)
+
+
+async def create_command_subprocess(cmd: str, cwd: Path) -> asyncio.subprocess.Process:
+    """
+    Starts a shell_command_after entry.
+
+    Plain commands are executed directly, which saves starting a shell. Commands using
+    shell syntax, or that cannot be executed directly (a shell builtin, a script without
+    execute permission...), go through the shell, which then reports the failure with
+    its usual exit code. Only stderr is kept, for error reporting.
+    """
+    if not needs_shell(cmd):
+        try:
+            return await asyncio.create_subprocess_exec(
+                *cmd.split(),
+                cwd=str(cwd),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                env=english_env,
+            )
+        except OSError:
+            pass
+
+    return await asyncio.create_subprocess_shell(
+        cmd,
+        cwd=str(cwd),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        env=english_env,
+    )
+
+
+class ModuleFailed(Exception):
+    """Raised in fail fast mode when a module could not be processed."""
+
+
 class SpecProcessor:
     """
     Processes a ProjectSpec by concurrently cloning and merging modules.
     """
 
-    def __init__(self, workdir: Path, concurrency: int = 4):
+    def __init__(
+        self,
+        workdir: Path,
+        concurrency: int = 4,
+        cache_dir: Optional[Path] = None,
+        fail_fast: bool = False,
+        per_host_concurrency: Optional[int] = None,
+    ):
         self.workdir = workdir
         self.concurrency = concurrency
-        self.semaphore = asyncio.Semaphore(concurrency)
+        self.fail_fast = fail_fast
+        # Fetching (network bound) and merging (local) hold separate slots, so a module
+        # merging does not keep the next one from fetching
+        self.limiter = DynamicLimiter(concurrency)
+        self.merge_limiter = DynamicLimiter(concurrency)
+        self.cache_dir = cache_dir
+        self.mirror_locks: Dict[str, asyncio.Lock] = {}
+        self.updated_mirrors: Dict[str, Optional[Path]] = {}
+        self.per_host_concurrency = per_host_concurrency
+        self.host_limiters: Dict[str, DynamicLimiter] = {}
+        self.local_modules: Optional[Set[str]] = None
+
+    def get_host_limiter(self, remote_url: str) -> DynamicLimiter | contextlib.nullcontext:
+        """
+        Returns the limiter to hold while talking to the host of remote_url.
+
+        Caps the network commands sent to a single forge at once, on top of the global
+        network limit. Does not limit anything when per_host_concurrency is not set.
+        """
+        if self.per_host_concurrency is None:
+            return contextlib.nullcontext()
+
+        host = get_remote_host(remote_url)
+        limiter = self.host_limiters.get(host)
+        if limiter is None:
+            limiter = self.host_limiters[host] = DynamicLimiter(self.per_host_concurrency)
+        return limiter
+
+    def get_mirror_path(self, remote_url: str) -> Path:
+        """Returns the path of the bare mirror of remote_url in the cache directory."""
+        # The same repository reached over ssh or https shares its mirror
+        url_key = hashlib.blake2b(normalize_remote_url(remote_url).encode(), digest_size=16).hexdigest()
+        return self.cache_dir / "git-mirrors" / f"{url_key}.git"
+
+    async def ensure_mirror(self, remote_url: str) -> Optional[Path]:
+        """
+        Creates or updates the local mirror of remote_url, at most once per run.
+
+        Returns the mirror path, or None if there is no cache directory or the mirror
+        could not be created.
+        """
+        if self.cache_dir is None:
+            return None
+
+        # The ssh and https spellings of a repository share one mirror, so they must also
+        # share its lock and be fetched only once
+        url_key = normalize_remote_url(remote_url)
+        lock = self.mirror_locks.setdefault(url_key, asyncio.Lock())
+        async with lock:
+            if url_key in self.updated_mirrors:
+                return self.updated_mirrors[url_key]
+
+            mirror_path = self.get_mirror_path(remote_url)
+            mirror_path.parent.mkdir(parents=True, exist_ok=True)
+
+            # The cache directory can be shared by several bl processes, the lock is
+            # released when its file descriptor is closed
+            lock_fd = os.open(f"{mirror_path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                await asyncio.to_thread(fcntl.flock, lock_fd, fcntl.LOCK_EX)
+                if mirror_path.is_dir():
+                    async with self.get_host_limiter(remote_url):
+                        ret, out, err = await run_git("fetch", "--prune", "origin", cwd=mirror_path)
+                else:
+                    # Blobless rather than treeless: serving a treeless fetch needs the trees
+                    # of the commits the fetching repository already has
+                    async with self.get_host_limiter(remote_url):
+                        ret, out, err = await run_git(
+                            "clone", "--bare", "--filter=blob:none", remote_url, str(mirror_path)
+                        )
+                    if ret == 0:
+                        # A bare clone has no fetch refspec, without it later fetches would not
+                        # update branches. Module repos fetch from the mirror with a filter,
+                        # which upload-pack ignores unless allowed
+                        ret, out, err = await run_git_batch(
+                            [
+                                ["config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*"],
+                                ["config", "uploadpack.allowFilter", "true"],
+                            ],
+                            cwd=mirror_path,
+                        )
+            finally:
+                os.close(lock_fd)
+
+            self.updated_mirrors[url_key] = mirror_path if ret == 0 else None
+            return self.updated_mirrors[url_key]
 
     @deprecated(
         "run_shell_commands is deprecated if used to apply patches. Use patch_globs properties in spec.yaml instead."
@@ -90,18 +275,13 @@ class SpecProcessor:
     async def run_shell_commands(self, progress: Progress, task_id: TaskID, spec: ModuleSpec, module_path: Path) -> int:
         for cmd in spec.shell_commands:
             progress.update(task_id, status=f"Running shell command: {cmd}...")
-            proc = await asyncio.create_subprocess_shell(
-                cmd,
-                cwd=str(module_path),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                env=english_env,
-            )
-            stdout, stderr = await proc.communicate()
+            proc = await create_command_subprocess(cmd, module_path)
+            # Noisy commands can print a lot, only the end of stderr matters to report a failure
+            stderr, _ = await asyncio.gather(read_stream_tail(proc.stderr), proc.wait())
             if proc.returncode != 0:
                 # This is a sanity check because people usually put "git am" commands
                 # in shell_commands, so we abort any ongoing git am
-                await run_git("am", "--abort", cwd=str(module_path))
+                await run_git("am", "--abort", cwd=str(module_path), capture_stdout=False)
                 progress.update(
                     task_id,
                     status=f"[red]Shell command failed: {cmd}\nError: {stderr.decode().strip()}",
@@ -122,19 +302,48 @@ class SpecProcessor:
             cwd=module_path,
         )
 
+    async def clone_from_mirror(
+        self, name: str, ref_spec_info: RefspecInfo, remote_url: str, module_path: Path, mirror_path: Path
+    ) -> tuple[int, str, str]:
+        """
+        Clones the history of a module repository from the local mirror of its remote.
+
+        The clone is treeless and not checked out, so only commits are copied. Its remote
+        is then pointed at remote_url, the checkout fetches the missing trees and blobs
+        from there like a regular clone would. The partial clone is removed on failure.
+        """
+        # A file:// url, a plain path makes a local clone that ignores --filter
+        args = create_clone_args(name, ref_spec_info, mirror_path.as_uri(), False, no_checkout=True)
+        ret, out, err = await run_git(*args, str(module_path))
+        if ret == 0:
+            ret, out, err = await run_git("remote", "set-url", ref_spec_info.remote, remote_url, cwd=module_path)
+        if ret == 0:
+            async with self.get_host_limiter(remote_url):
+                ret, out, err = await run_git("checkout", ref_spec_info.refspec, cwd=module_path)
+        if ret != 0:
+            await asyncio.to_thread(shutil.rmtree, module_path, ignore_errors=True)
+        return ret, out, err
+
     async def clone_base_repo_ref(
         self, name: str, ref_spec_info: RefspecInfo, remote_url: str, module_path: Path, shallow: bool
     ) -> tuple[int, str, str]:
-        args = create_clone_args(name, ref_spec_info, remote_url, shallow)
+        ret = -1
+        # A depth 1 clone is already the cheapest, and odoo/odoo is too big to mirror
+        if name != "odoo" and not shallow and ref_spec_info.type == OriginType.BRANCH:
+            mirror_path = await self.ensure_mirror(remote_url)
+            if mirror_path is not None:
+                ret, out, err = await self.clone_from_mirror(name, ref_spec_info, remote_url, module_path, mirror_path)
 
-        ret, out, err = await run_git(
-            *args,
-            str(module_path),
-        )
+        if ret != 0:
+            async with self.get_host_limiter(remote_url):
+                ret, out, err = await run_git(
+                    *create_clone_args(name, ref_spec_info, remote_url, shallow),
+                    str(module_path),
+                )
 
         # if it's a ref we need to manually create a base branch because we cannot
         # merge in a detached head
-        local_ref = get_local_ref(ref_spec_info)
+        local_ref = ref_spec_info.local_ref
         ret, out, err = await run_git(
             "checkout",
             "-b",
@@ -157,13 +366,39 @@ class SpecProcessor:
         # I think the idea would be to not fetch shallow but fetch treeless and do a merge-base
         # then fetch the required data and then merge
         progress.update(task_id, status=f"Merging {local_ref}", advance=0.1)
+
+        # Nothing to merge when HEAD can simply move to the ref, like `git merge` would
+        ret, out, err = await run_git("merge", "--ff-only", local_ref, cwd=module_path, capture_stdout=False)
+        if ret == 0:
+            return ret, err
+
+        # Merge in the object database: a conflict is reported without writing conflicted
+        # files to the working tree and aborting, a clean merge is committed from the
+        # resulting tree instead of being computed a second time by `git merge`.
+        # Exit code 1 means conflicts, anything above is an error (e.g. git < 2.38)
+        # and the regular merge below reports it.
+        ret, out, err = await run_git("merge-tree", "--write-tree", "--name-only", "HEAD", local_ref, cwd=module_path)
+        if ret == 1:
+            # First line is the resulting tree, then conflicted files and messages
+            conflict = out.partition("\n")[2]
+            progress.update(task_id, status=f"[red]Merge conflict in {origin.refspec}: {conflict}")
+            return -1, conflict
+        if ret == 0:
+            ret, merge_commit, err = await run_git(
+                "commit-tree", out, "-p", "HEAD", "-p", local_ref, "-m", f"Merge branch '{local_ref}'", cwd=module_path
+            )
+            if ret == 0:
+                # Moves the branch and updates the checked out files from HEAD to the merge
+                ret, out, err = await run_git("reset", "--keep", merge_commit, cwd=module_path, capture_stdout=False)
+            return ret, err
+
         ret, out, err = await run_git("merge", "--no-edit", local_ref, cwd=module_path)
-        ret, err = normalize_merge_result(ret, out, err)
+        ret, err = normalize_merge_result(ret, out, err, module_path)
 
-        if "CONFLICT" in err:
+        if ret == -1:
             progress.update(task_id, status=f"[red]Merge conflict in {origin.refspec}: {err}")
             # In case of conflict, we might want to abort the merge
-            await run_git("merge", "--abort", cwd=module_path)
+            await run_git("merge", "--abort", cwd=module_path, capture_stdout=False)
         return ret, err
 
     async def setup_new_repo(
@@ -198,50 +433,88 @@ class SpecProcessor:
     async def reset_repo_for_work(
         self, progress: Progress, task_id: TaskID, spec: ModuleSpec, root_refspec_info: RefspecInfo, module_path: Path
     ) -> int:
-        ret, out, err = await run_git("status", "--porcelain", cwd=module_path)
-
-        if out != "":
-            progress.update(task_id, status=f"[red]Repo is dirty:\n{out}")
-            return ret
+        # Compares the index with HEAD without walking the worktree for untracked files,
+        # which reset --hard leaves alone anyway
+        ret, out, err = await run_git("diff-index", "--quiet", "HEAD", "--", cwd=module_path)
+        if ret != 0:
+            # diff-index does not refresh the index, a file only touched shows up too:
+            # let status refresh it and tell which files really changed
+            ret, out, err = await run_git("status", "--porcelain", "--untracked-files=no", cwd=module_path)
+            if out != "":
+                progress.update(task_id, status=f"[red]Repo is dirty:\n{out}")
+                return ret
         # Reset all the local origin to their remote origins
         progress.update(
             task_id,
             status=(f"Resetting existing repository for {root_refspec_info.remote}/{root_refspec_info.refspec}"),
         )
 
-        s_ret, s_out, s_err = await run_git("rev-parse", "--is-shallow-repository", cwd=module_path)
-        if len(spec.refspec_info) > 1 and s_out == "true":
-            await run_git("fetch", "--unshallow", cwd=module_path)
-
         reset_target = f"{root_refspec_info.remote}/{root_refspec_info.refspec}"
+
+        fetch_args = []
+        shallow = await is_shallow_repository(module_path)
+        if shallow and len(spec.refspec_info) > 1:
+            # Merges need the history for merge bases
+            fetch_args += ["--unshallow"]
+        if root_refspec_info.type != OriginType.REF:
+            # The root ref is not fetched with the others, bring its remote tracking ref
+            # up to date so the reset does not go back to the state of the first clone
+            if shallow and len(spec.refspec_info) == 1:
+                fetch_args += ["--depth", "1"]
+            fetch_args += [root_refspec_info.remote, f"+{root_refspec_info.refspec}:refs/remotes/{reset_target}"]
+        if fetch_args:
+            # Only commits are fetched, the clone's remote.<name>.partialCloneFilter (tree:0)
+            # applies to this fetch too
+            remote_url = spec.remotes.get(root_refspec_info.remote) or root_refspec_info.remote
+            async with self.get_host_limiter(remote_url):
+                await run_git("fetch", "--no-tags", *fetch_args, cwd=module_path, capture_stdout=False)
+
         ret, out, err = await run_git("reset", "--hard", reset_target, cwd=module_path)
         if ret != 0:
             progress.update(task_id, status=f"[red]Reset failed: {err}")
             return ret
 
-        for refspec_info in spec.refspec_info[1:]:
-            local_ref = get_local_ref(refspec_info)
+        local_refs = [refspec_info.local_ref for refspec_info in spec.refspec_info[1:]]
+        if local_refs:
             # This is probably the best thing but for now this works good enough
             # TODO(franz): find something better
-            ret, out, err = await run_git("branch", "-d", local_ref, cwd=module_path)
+            # git branch -d deletes every branch it can, even if some of them fail
+            ret, out, err = await run_git("branch", "-d", *local_refs, cwd=module_path, capture_stdout=False)
 
     def link_all_modules(self, module_list: List[str], module_path: Path) -> tuple[int, str]:
         links_path = self.workdir / "links"
         links_path.mkdir(exist_ok=True)
 
-        # Remove all symlink
-
-        for module_name in module_list:
-            try:
-                path_src_symlink = module_path / module_name
-                path_dest_symlink = links_path / module_name
+        # Relative path from the links directory to the module repo, the same for every module
+        relative_module_path = os.path.relpath(module_path, links_path)
 
-                if path_dest_symlink.is_symlink():
-                    path_dest_symlink.unlink()
+        try:
+            with os.scandir(links_path) as entries:
+                existing_links = {entry.name for entry in entries if entry.is_symlink()}
 
-                os.symlink(path_src_symlink.relative_to(links_path, walk_up=True), path_dest_symlink, True)
-            except OSError as e:
-                return -1, str(e)
+            links_fd = os.open(links_path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for module_name in module_list:
+                    link_target = os.path.join(relative_module_path, module_name)
+                    # Leave links that are already right alone, tools watching the directory
+                    # do not need to see them change
+                    if module_name in existing_links and os.readlink(module_name, dir_fd=links_fd) == link_target:
+                        continue
+
+                    # Create the link aside then rename it over the previous one, so the
+                    # module is never missing from the links directory
+                    temporary_name = f".{module_name}.{os.getpid()}.tmp"
+                    try:
+                        os.symlink(link_target, temporary_name, target_is_directory=True, dir_fd=links_fd)
+                    except FileExistsError:
+                        # Left over by an interrupted run
+                        os.unlink(temporary_name, dir_fd=links_fd)
+                        os.symlink(link_target, temporary_name, target_is_directory=True, dir_fd=links_fd)
+                    os.replace(temporary_name, module_name, src_dir_fd=links_fd, dst_dir_fd=links_fd)
+            finally:
+                os.close(links_fd)
+        except OSError as e:
+            return -1, str(e)
 
         return 0, ""
 
@@ -257,7 +530,7 @@ class SpecProcessor:
         # This is weird...
         remote_url = spec.remotes.get(refspec_info.remote) or refspec_info.remote
 
-        local_ref = get_local_ref(refspec_info)
+        local_ref = refspec_info.local_ref
         remote_ref = refspec_info.refspec
 
         ret, err = await self.try_merge(progress, task_id, remote_url, local_ref, module_path, refspec_info)
@@ -268,37 +541,83 @@ class SpecProcessor:
         return 0, ""
 
     def get_refspec_by_remote(self, refspec_info_list: List[RefspecInfo]) -> Dict[str, List[RefspecInfo]]:
-        result = {}
+        result = defaultdict(list)
 
         for spec in refspec_info_list:
-            spec_list = result.get(spec.remote, [])
-            spec_list.append(spec)
-            result[spec.remote] = spec_list
+            result[spec.remote].append(spec)
 
-        return result
+        return dict(result)
 
-    async def fetch_multi(self, remote: str, refspec_info_list: List[RefspecInfo], module_path: Path):
+    async def fetch_multi(
+        self,
+        name: str,
+        remote: str,
+        refspec_info_list: List[RefspecInfo],
+        module_path: Path,
+        remote_url: Optional[str] = None,
+    ):
+        # Branches are taken from the local mirror, which is fetched from the network once
+        # per run however many modules use this url. Other refs (PRs, shas) are not mirrored,
+        # and like in clone_base_repo_ref no remote of odoo is
+        mirrored = []
+        if remote_url and name != "odoo":
+            mirrored = [refspec_info for refspec_info in refspec_info_list if refspec_info.type == OriginType.BRANCH]
+        mirror_path = await self.ensure_mirror(remote_url) if mirrored else None
+        if mirror_path is not None:
+            # The mirror is not the promisor remote, its partialCloneFilter does not apply
+            ret, out, err = await run_git(
+                "fetch",
+                "--no-tags",
+                "--filter=tree:0",
+                mirror_path.as_uri(),
+                *(f"{refspec_info.refspec}:{refspec_info.local_ref}" for refspec_info in mirrored),
+                cwd=module_path,
+            )
+            # On failure (e.g. a tag the mirror did not follow) everything is fetched from the remote
+            if ret == 0:
+                refspec_info_list = [
+                    refspec_info for refspec_info in refspec_info_list if refspec_info.type != OriginType.BRANCH
+                ]
+                if not refspec_info_list:
+                    return ret, out, err
+
+        # Only the requested refs are needed, not the tags pointing into their history
         args = [
             "fetch",
+            "--no-tags",
             "-j",
             str(self.concurrency),
             remote,
         ]
 
         for refspec_info in refspec_info_list:
-            local_ref = get_local_ref(refspec_info)
+            local_ref = refspec_info.local_ref
             args += [f"{refspec_info.refspec}:{local_ref}"]
 
-        ret, out, err = await run_git(*args, cwd=module_path)
+        async with self.get_host_limiter(remote_url or remote):
+            ret, out, err = await run_git(*args, cwd=module_path)
 
         return ret, out, err
 
+    def get_local_modules(self) -> Set[str]:
+        """
+        Returns the names of the entries of the links directory that are not symlinks.
+
+        The directory is read once per run: this only ever adds symlinks to it.
+        """
+        if self.local_modules is None:
+            try:
+                with os.scandir(os.path.join(self.workdir, "links")) as entries:
+                    self.local_modules = {entry.name for entry in entries if not entry.is_symlink()}
+            except (FileNotFoundError, NotADirectoryError):
+                self.local_modules = set()
+        return self.local_modules
+
     def filter_non_link_module(self, spec: ModuleSpec):
         result = []
-        base_path_links = self.workdir / "links"
+        local_modules = self.get_local_modules()
         for module in spec.modules:
-            path = base_path_links / module
-            if path.is_symlink() or not path.exists():
+            if module not in local_modules:
                 result.append(module)
             else:
                 console.print(
@@ -307,108 +626,319 @@ class SpecProcessor:
                 )
         return result
 
-    async def process_module(
-        self, name: str, spec: ModuleSpec, progress: Progress, count_progress: Progress, count_task: TaskID
-    ) -> int:
-        """Processes a single ModuleSpec."""
-        total_steps = len(spec.refspec_info) + 1 if spec.refspec_info else 1
-
-        symlink_modules = self.filter_non_link_module(spec)
-
-        async with self.semaphore:
-            task_id = progress.add_task(f"[cyan]{name}", status="Waiting...", total=total_steps)
-            try:
-                if not spec.refspec_info:
-                    progress.update(task_id, status="[yellow]No origins defined", completed=1)
-                    return -1
-
-                module_path = get_module_path(self.workdir, name, spec)
+    async def resolve_remote_refs(self, remote_url: str, refspec_list: List[RefspecInfo]) -> Dict[str, str]:
+        """Resolves branches and PR refs of a remote to their current sha with one `git ls-remote`."""
+        async with self.get_host_limiter(remote_url):
+            ret, out, err = await run_git("ls-remote", remote_url, *(r.refspec for r in refspec_list))
+        if ret != 0:
+            return {}
+
+        remote_refs = {}
+        for line in out.splitlines():
+            sha, _, ref = line.partition("\t")
+            remote_refs[ref] = sha
+
+        resolved = {}
+        for refspec_info in refspec_list:
+            refspec = refspec_info.refspec
+            for candidate in (refspec, f"refs/heads/{refspec}", f"refs/tags/{refspec}"):
+                if candidate in remote_refs:
+                    resolved[refspec] = remote_refs[candidate]
+                    break
+        return resolved
+
+    async def resolve_spec_remote_refs(self, spec: ModuleSpec) -> List[Optional[str]]:
+        """Resolves the refs of a spec to the sha their remote currently has, None for unknown refs."""
+        to_resolve: Dict[str, List[RefspecInfo]] = {}
+        for refspec_info in spec.refspec_info:
+            if refspec_info.type != OriginType.REF:
+                remote_url = spec.remotes.get(refspec_info.remote) or refspec_info.remote
+                to_resolve.setdefault(remote_url, []).append(refspec_info)
+
+        remote_urls = list(to_resolve)
+        resolved_by_url = dict(
+            zip(
+                remote_urls,
+                await asyncio.gather(*(self.resolve_remote_refs(url, to_resolve[url]) for url in remote_urls)),
+            )
+        )
 
-                # 1. Initialize with first origin
-                root_refspec_info = spec.refspec_info[0]
-                remote_url = spec.remotes.get(root_refspec_info.remote) or root_refspec_info.remote
+        shas = []
+        for refspec_info in spec.refspec_info:
+            if refspec_info.type == OriginType.REF:
+                shas.append(refspec_info.refspec)
+            else:
+                remote_url = spec.remotes.get(refspec_info.remote) or refspec_info.remote
+                shas.append(resolved_by_url[remote_url].get(refspec_info.refspec))
+        return shas
+
+    async def resolve_spec_fetched_refs(self, spec: ModuleSpec, module_path: Path) -> List[Optional[str]]:
+        """Resolves the refs of a spec to the sha fetched in the module repository, None for missing refs."""
+        root_refspec_info = spec.refspec_info[0]
+        # The root is what reset_repo_for_work resets to, the others are fetched into their local ref
+        local_refs = [f"{root_refspec_info.remote}/{root_refspec_info.refspec}"]
+        local_refs += [refspec_info.local_ref for refspec_info in spec.refspec_info[1:]]
+        shas = await run_git_batch_check(local_refs, cwd=module_path)
+        return [
+            refspec_info.refspec if refspec_info.type == OriginType.REF else sha
+            for refspec_info, sha in zip(spec.refspec_info, shas)
+        ]
 
-                if not module_path.exists() or not module_path.is_dir():
-                    await self.setup_new_repo(progress, task_id, spec, name, root_refspec_info, remote_url, module_path)
+    async def get_sync_fingerprint(
+        self, spec: ModuleSpec, module_path: Path, symlink_modules: List[str], from_fetched_refs: bool = False
+    ) -> Optional[str]:
+        """
+        Computes a digest of the remote state a module would be built from.
+
+        The refs are resolved with ls-remote, or from the module repository once they were
+        fetched if from_fetched_refs is set. Returns None when the state cannot be
+        fingerprinted: a ref or patch file could not be resolved, or the module runs shell
+        commands whose effect we cannot track.
+        """
+        if spec.shell_commands:
+            return None
+
+        if from_fetched_refs:
+            shas = await self.resolve_spec_fetched_refs(spec, module_path)
+        else:
+            shas = await self.resolve_spec_remote_refs(spec)
+
+        # The modules to link decide the sparse checkout, a local module removed from the
+        # links directory must be checked out again
+        lines = [" ".join(spec.modules), f"links {' '.join(symlink_modules)}"]
+        for refspec_info, sha in zip(spec.refspec_info, shas):
+            if sha is None:
+                return None
+            remote_url = spec.remotes.get(refspec_info.remote) or refspec_info.remote
+            lines.append(f"{remote_url} {refspec_info.refspec} {sha}")
+
+        if spec.patch_globs_to_apply:
+            for patch_file in expand_patch_globs(spec.patch_globs_to_apply, module_path):
+                try:
+                    patch_digest = hashlib.blake2b((module_path / patch_file).read_bytes(), digest_size=16)
+                except OSError:
+                    return None
+                lines.append(f"patch {patch_file} {patch_digest.hexdigest()}")
+
+        return hashlib.blake2b("\n".join(lines).encode(), digest_size=16).hexdigest()
+
+    def get_sync_file(self, module_path: Path) -> Path:
+        """Returns the file recording the fingerprint and HEAD of the last successful update."""
+        return module_path / ".git" / "bl-lastsync"
+
+    async def is_up_to_date(self, module_path: Path, fingerprint: str) -> bool:
+        """Tells whether the module was last built from the same remote state and was not moved since."""
+        try:
+            recorded_fingerprint, recorded_head = self.get_sync_file(module_path).read_text().split()
+        except (OSError, ValueError):
+            return False
+
+        if recorded_fingerprint != fingerprint:
+            return False
+
+        ret, head, err = await run_git("rev-parse", "HEAD", cwd=module_path)
+        return ret == 0 and head == recorded_head
+
+    async def write_sync_file(self, module_path: Path, fingerprint: str) -> None:
+        ret, head, err = await run_git("rev-parse", "HEAD", cwd=module_path)
+        if ret == 0:
+            self.get_sync_file(module_path).write_text(f"{fingerprint}\n{head}\n")
+
+    async def fetch_module_repo(
+        self,
+        progress: Progress,
+        task_id: TaskID,
+        name: str,
+        spec: ModuleSpec,
+        symlink_modules: List[str],
+        module_path: Path,
+    ) -> None:
+        """Clones or resets the module repository and fetches all of its refs."""
+        # 1. Initialize with first origin
+        root_refspec_info = spec.refspec_info[0]
+        remote_url = spec.remotes.get(root_refspec_info.remote) or root_refspec_info.remote
+
+        if not module_path.is_dir():
+            await self.setup_new_repo(progress, task_id, spec, name, root_refspec_info, remote_url, module_path)
+        else:
+            await self.reset_repo_for_work(progress, task_id, spec, root_refspec_info, module_path)
+
+        if name != "odoo":
+            # We don't do sparse checkout for odoo because the odoo repo does not work at
+            # all like the other repos (modules are in addons/ and src/addons/) instead of
+            # at the root of the repo
+
+            # TODO(franz): there is probably a way to make it work, but for now we skip it
+            # this is probably a good way to gain performance
+
+            # 2. Sparse Checkout setup
+            progress.update(task_id, status="Configuring sparse checkout...")
+            sparse_commands = [["sparse-checkout", "init", "--cone"]]
+            if symlink_modules:
+                # Write the patterns ourselves rather than passing every module on the
+                # command line of `sparse-checkout set`, then have git apply them
+                sparse_file = module_path / ".git" / "info" / "sparse-checkout"
+                sparse_patterns = create_cone_sparse_patterns(spec.modules)
+                try:
+                    current_patterns = sparse_file.read_bytes()
+                except OSError:
+                    current_patterns = None
+
+                if current_patterns == sparse_patterns:
+                    # Set up by a previous run with the same modules, nothing to apply
+                    sparse_commands = []
                 else:
-                    await self.reset_repo_for_work(progress, task_id, spec, root_refspec_info, module_path)
+                    sparse_file.parent.mkdir(exist_ok=True)
+                    sparse_file.write_bytes(sparse_patterns)
+                    sparse_commands.append(["sparse-checkout", "reapply"])
+            if sparse_commands:
+                await run_git_batch(sparse_commands, cwd=module_path)
+
+        checkout_target = "merged"
+
+        # Some of these fail on an existing repo (branch or remote already there),
+        # which is fine, run_git_batch keeps going like separate calls would
+        setup_commands = [["checkout", "-b", checkout_target]]
+        for remote, remote_url in spec.remotes.items():
+            setup_commands += [
+                ["remote", "add", remote, remote_url],
+                ["config", f"remote.{remote}.partialCloneFilter", "tree:0"],
+                ["config", f"remote.{remote}.promisor", "true"],
+            ]
+        await run_git_batch(setup_commands, cwd=module_path)
+        progress.advance(task_id)
 
-                if name != "odoo":
-                    # We don't do sparse checkout for odoo because the odoo repo does not work at
-                    # all like the other repos (modules are in addons/ and src/addons/) instead of
-                    # at the root of the repo
+        # TODO(franz) fetch and merge should be done separately
+        # fetch can be done in parallel by git with -j X and putting several refspec as parameters
+        # to git fetch
+        refspec_by_remote: Dict[str, List[RefspecInfo]] = self.get_refspec_by_remote(spec.refspec_info[1:])
+
+        if len(refspec_by_remote) > 1 and not await is_shallow_repository(module_path):
+            # Remotes are fetched concurrently. Not for shallow repos, every fetch
+            # rewrites .git/shallow and they would fight over its lock
+            progress.update(task_id, status=f"Fetching multi from {', '.join(refspec_by_remote)}")
+            await asyncio.gather(
+                *(
+                    self.fetch_multi(name, remote, refspec_list, module_path, spec.remotes.get(remote))
+                    for remote, refspec_list in refspec_by_remote.items()
+                )
+            )
+        else:
+            for remote, refspec_list in refspec_by_remote.items():
+                progress.update(task_id, status=f"Fetching multi from {remote}")
+                await self.fetch_multi(name, remote, refspec_list, module_path, spec.remotes.get(remote))
 
-                    # TODO(franz): there is probably a way to make it work, but for now we skip it
-                    # this is probably a good way to gain performance
+    async def merge_module_repo(self, progress: Progress, task_id: TaskID, spec: ModuleSpec, module_path: Path) -> int:
+        """Merges the fetched refs, then runs commands and applies patches on the module repository."""
+        root_refspec_info = spec.refspec_info[0]
 
-                    # 2. Sparse Checkout setup
-                    progress.update(task_id, status="Configuring sparse checkout...")
-                    await run_git("sparse-checkout", "init", "--cone", cwd=module_path)
-                    if symlink_modules:
-                        await run_git("sparse-checkout", "set", *spec.modules, cwd=module_path)
+        # 4. Merge remaining origins
+        for refspec_info in spec.refspec_info[1:]:
+            ret, err = await self.merge_spec_into_tree(
+                progress, task_id, spec, refspec_info, root_refspec_info, module_path
+            )
+            if ret != 0:
+                progress.update(task_id, status=f"[purple]Merge failed from {refspec_info.refspec}: {err}")
+                return -1
 
-                checkout_target = "merged"
+        if spec.shell_commands:
+            ret = await self.run_shell_commands(progress, task_id, spec, module_path)
+            if ret != 0:
+                return ret
+
+        if spec.patch_globs_to_apply:
+            # Apply the whole series in a single git am
+            patch_files = expand_patch_globs(spec.patch_globs_to_apply, module_path)
+            progress.update(task_id, status=f"Applying patches: {', '.join(spec.patch_globs_to_apply)}...", advance=0.1)
+            ret, out, err = await run_git("am", *patch_files, cwd=module_path)
+            if ret != 0:
+                await run_git("am", "--abort", cwd=module_path, capture_stdout=False)
+                progress.update(task_id, status=f"[red]Applying patches failed: {err}")
+                return ret
 
-                await run_git("checkout", "-b", checkout_target, cwd=module_path)
-                progress.advance(task_id)
+        return 0
 
-                for remote, remote_url in spec.remotes.items():
-                    await run_git("remote", "add", remote, remote_url, cwd=module_path)
-                    await run_git("config", f"remote.{remote}.partialCloneFilter", "tree:0", cwd=module_path)
-                    await run_git("config", f"remote.{remote}.promisor", "true", cwd=module_path)
+    async def process_module(
+        self, name: str, spec: ModuleSpec, progress: Progress, count_progress: Progress, count_task: TaskID
+    ) -> int:
+        """Processes a single ModuleSpec."""
+        total_steps = len(spec.refspec_info) + 1 if spec.refspec_info else 1
 
-                # TODO(franz) fetch and merge should be done separately
-                # fetch can be done in parallel by git with -j X and putting several refspec as parameters
-                # to git fetch
-                refspec_by_remote: Dict[str, List[RefspecInfo]] = self.get_refspec_by_remote(spec.refspec_info[1:])
+        symlink_modules = self.filter_non_link_module(spec)
 
-                for remote, refspec_list in refspec_by_remote.items():
-                    progress.update(task_id, status=f"Fetching multi from {remote}")
-                    await self.fetch_multi(remote, refspec_list, module_path)
+        # Hidden until the module gets its first slot, the table only lists modules being worked on
+        task_id = progress.add_task(f"[cyan]{name}", status="Waiting...", total=total_steps, visible=False)
+        try:
+            if not spec.refspec_info:
+                progress.update(task_id, status="[yellow]No origins defined", completed=1, visible=True)
+                return -1
 
-                # 4. Fetch and Merge remaining origins
-                for refspec_info in spec.refspec_info[1:]:
-                    ret, err = await self.merge_spec_into_tree(
-                        progress, task_id, spec, refspec_info, root_refspec_info, module_path
+            module_path = get_module_path(self.workdir, name, spec)
+
+            async with self.limiter:
+                progress.update(task_id, visible=True)
+                fingerprint = None
+                # Only a module built before can be up to date, no ls-remote round trip on a first build
+                if self.get_sync_file(module_path).is_file():
+                    fingerprint = await self.get_sync_fingerprint(spec, module_path, symlink_modules)
+                up_to_date = fingerprint is not None and await self.is_up_to_date(module_path, fingerprint)
+                if up_to_date:
+                    progress.update(task_id, status="[green]Up to date", completed=total_steps)
+                else:
+                    await self.fetch_module_repo(progress, task_id, name, spec, symlink_modules, module_path)
+                    # Record what was fetched, the remotes may have moved since ls-remote
+                    fingerprint = await self.get_sync_fingerprint(
+                        spec, module_path, symlink_modules, from_fetched_refs=True
                     )
-                    if ret != 0:
-                        progress.update(task_id, status=f"[purple]Merge failed from {refspec_info.refspec}: {err}")
-                        return -1
 
-                if spec.shell_commands:
-                    ret = await self.run_shell_commands(progress, task_id, spec, module_path)
+            if not up_to_date:
+                async with self.merge_limiter:
+                    ret = await self.merge_module_repo(progress, task_id, spec, module_path)
                     if ret != 0:
                         return ret
+                    if fingerprint is not None:
+                        await self.write_sync_file(module_path, fingerprint)
 
-                if spec.patch_globs_to_apply:
-                    for glob in spec.patch_globs_to_apply:
-                        progress.update(task_id, status=f"Applying patches: {glob}...", advance=0.1)
-                        ret, out, err = await run_git("am", glob, cwd=module_path)
-                        if ret != 0:
-                            await run_git("am", "--abort", cwd=module_path)
-                            progress.update(task_id, status=f"[red]Applying patches failed: {err}")
-                            return ret
-
-                progress.update(task_id, status="Linking directory")
-                if name != "odoo":
-                    ret, err = self.link_all_modules(symlink_modules, module_path)
-                    if ret != 0:
-                        progress.update(task_id, status=f"[red]Could not link modules: {err}")
-                        return ret
+            progress.update(task_id, status="Linking directory")
+            if name != "odoo":
+                # Plain blocking filesystem calls, keep them off the event loop driving the git processes
+                ret, err = await asyncio.to_thread(self.link_all_modules, symlink_modules, module_path)
+                if ret != 0:
+                    progress.update(task_id, status=f"[red]Could not link modules: {err}")
+                    return ret
 
-                progress.update(task_id, status="[green]Complete")
-                progress.remove_task(task_id)
-                count_progress.advance(count_task)
+            progress.update(task_id, status="[green]Complete")
+            progress.remove_task(task_id)
+            count_progress.advance(count_task)
 
-            except Exception as e:
-                progress.update(task_id, status=f"[red]Error: {str(e)}")
-                return -1
+        except Exception as e:
+            progress.update(task_id, status=f"[red]Error: {str(e)}", visible=True)
+            return -1
 
         return 0
 
+    async def run_module(
+        self, name: str, spec: ModuleSpec, progress: Progress, count_progress: Progress, count_task: TaskID
+    ) -> int:
+        """Runs process_module, raising ModuleFailed on failure in fail_fast mode to cancel the other modules."""
+        ret = await self.process_module(name, spec, progress, count_progress, count_task)
+        if ret != 0 and self.fail_fast:
+            raise ModuleFailed(name)
+        return ret
+
     async def process_project(self, project_spec: ProjectSpec) -> None:
         """Processes all modules in a ProjectSpec."""
         (self.workdir / "external-src").mkdir(parents=True, exist_ok=True)
+        await set_git_concurrency(self.concurrency)
+
+        # Modules without origins have nothing to process, they are reported once and
+        # still fail the run
+        specs = {name: spec for name, spec in project_spec.specs.items() if spec.refspec_info}
+        no_origin_modules = [name for name in project_spec.specs if name not in specs]
+        if no_origin_modules:
+            console.print(f"[yellow]No origins defined for:[/] {', '.join(no_origin_modules)}")
+        if no_origin_modules and self.fail_fast:
+            raise Exception()
 
         task_list_progress = Progress(
             SpinnerColumn(),
@@ -423,7 +953,7 @@ class SpecProcessor:
             BarColumn(),
             MofNCompleteColumn(),
         )
-        count_task = task_count_progress.add_task("Processing Modules", total=len(project_spec.specs))
+        count_task = task_count_progress.add_task("Processing Modules", total=len(specs))
 
         progress_table = Table.grid()
         progress_table.add_row(
@@ -433,27 +963,41 @@ class SpecProcessor:
             task_count_progress,
         )
 
-        with Live(progress_table, console=console, refresh_per_second=10):
-            tasks = []
-            for name, spec in project_spec.specs.items():
-                tasks.append(
-                    self.process_module(
-                        name,
-                        spec,
-                        task_list_progress,
-                        task_count_progress,
-                        count_task,
-                    )
-                )
+        # Without a terminal only the final state is printed, no need for the refresh thread.
+        # Statuses change on git process boundaries, a few redraws per second are enough
+        with Live(progress_table, console=console, refresh_per_second=4, auto_refresh=console.is_terminal):
+            try:
+                async with asyncio.TaskGroup() as task_group:
+                    tasks = [
+                        task_group.create_task(
+                            self.run_module(
+                                name,
+                                spec,
+                                task_list_progress,
+                                task_count_progress,
+                                count_task,
+                            )
+                        )
+                        for name, spec in specs.items()
+                    ]
+            except ExceptionGroup as group:
+                if group.subgroup(ModuleFailed) is None:
+                    raise
+                # fail_fast: the other modules were cancelled
+                raise Exception()
 
-            # this should error if a task crashes
-            return_codes = await asyncio.gather(*tasks)
-            if any(return_codes):
+            if no_origin_modules or any(task.result() for task in tasks):
                 raise Exception()
 
 
-async def process_project(project_spec: ProjectSpec, concurrency: int = 4) -> None:
+async def process_project(
+    project_spec: ProjectSpec,
+    concurrency: int = 4,
+    cache_dir: Optional[Path] = None,
+    fail_fast: bool = False,
+    per_host_concurrency: Optional[int] = None,
+) -> None:
     """Helper function to run the SpecProcessor."""
-    processor = SpecProcessor(project_spec.workdir, concurrency)
+    processor = SpecProcessor(project_spec.workdir, concurrency, cache_dir, fail_fast, per_host_concurrency)
     # project_spec.specs = {name: spec for name, spec in project_spec.specs.items() if name == "sale-workflow"}
     return await processor.process_project(project_spec)
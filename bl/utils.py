@@ -1,16 +1,129 @@
 import asyncio
 import os
+import shlex
+import weakref
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import warnings
-from bl.spec_parser import ModuleSpec, OriginType, RefspecInfo
+from bl.spec_parser import ModuleSpec, OriginType
 
 
 english_env = os.environ.copy()
 # Ensure git outputs in English for consistent parsing
 english_env["LANG"] = "en_US.UTF-8"
 
+# Environment of the git processes. LC_ALL also wins over a user's LC_ALL, which LANG
+# does not, so the messages we parse (CONFLICT, ...) are always untranslated. Optional
+# locks are the index refreshes of read only commands, which we do not need.
+git_env = {**english_env, "LC_ALL": "C", "GIT_OPTIONAL_LOCKS": "0"}
+
+
+class DynamicLimiter:
+    """
+    Concurrency limiter similar to asyncio.Semaphore but whose limit can be changed at runtime.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self) -> None:
+        async with self.condition:
+            self.active -= 1
+            # Wake every waiter, wait_for checks the limit again. A single notified waiter
+            # that gets cancelled before it resumes would take the wakeup with it
+            self.condition.notify_all()
+
+    async def resize(self, limit: int) -> None:
+        """Changes the limit, waking up waiters if it grew."""
+        async with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.release()
+
+
+# Default caps on the number of git processes alive at the same time, across all modules,
+# until set_git_concurrency is called. Network bound commands get their own pool so they
+# do not starve local ones.
+GIT_NETWORK_CONCURRENCY = 16
+GIT_LOCAL_CONCURRENCY = min(32, (os.cpu_count() or 1) * 4)
+GIT_NETWORK_COMMANDS = frozenset(("clone", "fetch", "pull", "push", "ls-remote"))
+
+# Limiters are bound to an event loop, so keep one pair per loop
+_git_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[DynamicLimiter, DynamicLimiter]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _get_git_limiters() -> "tuple[DynamicLimiter, DynamicLimiter]":
+    """Returns the (network, local) limiters of the running event loop."""
+    loop = asyncio.get_running_loop()
+    limiters = _git_limiters.get(loop)
+    if limiters is None:
+        limiters = (DynamicLimiter(GIT_NETWORK_CONCURRENCY), DynamicLimiter(GIT_LOCAL_CONCURRENCY))
+        _git_limiters[loop] = limiters
+    return limiters
+
+
+def get_git_limiter(command: str) -> DynamicLimiter:
+    """Returns the limiter a git subcommand must hold while its process runs."""
+    network_limiter, local_limiter = _get_git_limiters()
+    return network_limiter if command in GIT_NETWORK_COMMANDS else local_limiter
+
+
+async def set_git_concurrency(concurrency: int) -> None:
+    """Lets up to concurrency network and as many local git processes run at once in the running event loop."""
+    for limiter in _get_git_limiters():
+        await limiter.resize(concurrency)
+
+
+def get_remote_host(remote_url: str) -> str:
+    """
+    Returns the host a remote url points to, without user or port.
+
+    Handles scheme urls (https://host/path) and scp like ones (user@host:path). Local
+    paths return an empty string.
+    """
+    scheme_end = remote_url.find("://")
+    if scheme_end >= 0:
+        authority = remote_url[scheme_end + 3 :].partition("/")[0]
+    else:
+        authority, colon, _ = remote_url.partition(":")
+        if not colon or "/" in authority:
+            return ""
+    return authority.rpartition("@")[2].partition(":")[0]
+
+
+def normalize_remote_url(remote_url: str) -> str:
+    """
+    Returns a transport independent form of remote_url, "host/path" without ".git".
+
+    https://github.com/OCA/web.git and git@github.com:OCA/web both give github.com/OCA/web.
+    Local paths are only stripped of their ".git" suffix.
+    """
+    host = get_remote_host(remote_url)
+    if not host:
+        path = remote_url
+    elif "://" in remote_url:
+        path = remote_url.partition("://")[2].partition("/")[2]
+    else:
+        path = remote_url.partition(":")[2]
+
+    path = path.rstrip("/").removesuffix(".git")
+    return f"{host.lower()}/{path.lstrip('/')}" if host else path
+
 
 def get_module_path(workdir: Path, module_name: str, module_spec: ModuleSpec) -> Path:
     """Returns the path to the module directory."""
@@ -27,21 +140,100 @@ def get_module_path(workdir: Path, module_name: str, module_spec: ModuleSpec) ->
         return workdir / "external-src" / module_name
 
 
-def get_local_ref(origin: RefspecInfo) -> str:
-    """Generates a local reference name for a given origin."""
-    return f"loc-{origin.ref_name or origin.refspec}"
+async def read_stream_tail(stream: asyncio.StreamReader, max_size: int = 64 * 1024) -> bytes:
+    """Reads stream until EOF, keeping only its last max_size bytes."""
+    tail = bytearray()
+    while chunk := await stream.read(64 * 1024):
+        tail += chunk
+        if len(tail) > max_size:
+            del tail[:-max_size]
+    return bytes(tail)
+
+
+async def run_git(*args: str, cwd: Optional[Path] = None, capture_stdout: bool = True) -> tuple[int, str, str]:
+    """
+    Executes a git command asynchronously.
+
+    With capture_stdout=False, the output is discarded by the OS and returned empty.
+    """
+    async with get_git_limiter(args[0] if args else ""):
+        proc = await asyncio.create_subprocess_exec(
+            "git",
+            *args,
+            stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd or None,
+            env=git_env,
+        )
+        # stdout is the result of the command, stderr is only kept for error messages
+        stdout, stderr, _ = await asyncio.gather(
+            proc.stdout.read() if capture_stdout else asyncio.sleep(0, b""),
+            read_stream_tail(proc.stderr),
+            proc.wait(),
+        )
+    returncode = proc.returncode if proc.returncode is not None else -1
+    return returncode, stdout.decode().strip(), stderr.decode().strip()
+
+
+async def is_shallow_repository(repo_path: Path) -> bool:
+    """
+    Tells whether the repository is shallow.
+
+    Checks for the `shallow` file git keeps in its directory instead of spawning
+    `git rev-parse --is-shallow-repository`, falling back to it when .git is not a directory.
+    """
+    git_dir = repo_path / ".git"
+    if git_dir.is_dir():
+        shallow_file = git_dir / "shallow"
+        return shallow_file.is_file() and shallow_file.stat().st_size > 0
 
+    ret, out, err = await run_git("rev-parse", "--is-shallow-repository", cwd=repo_path)
+    return out == "true"
 
-async def run_git(*args: str, cwd: Optional[Path] = None) -> tuple[int, str, str]:
-    """Executes a git command asynchronously."""
-    proc = await asyncio.create_subprocess_exec(
-        "git",
-        *args,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-        cwd=str(cwd) if cwd else None,
-        env=english_env,
-    )
-    stdout, stderr = await proc.communicate()
+
+async def run_git_batch(commands: List[List[str]], cwd: Optional[Path] = None) -> tuple[int, str, str]:
+    """
+    Executes several git commands in a single shell process.
+
+    Each command runs even if a previous one failed, like a sequence of run_git calls
+    whose results are ignored. The return code is the one of the last command.
+    """
+    script = "; ".join(shlex.join(["git", *command]) for command in commands)
+    async with get_git_limiter(commands[0][0] if commands and commands[0] else ""):
+        proc = await asyncio.create_subprocess_exec(
+            "sh",
+            "-c",
+            script,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd or None,
+            env=git_env,
+        )
+        stdout, stderr = await proc.communicate()
     returncode = proc.returncode if proc.returncode is not None else -1
     return returncode, stdout.decode().strip(), stderr.decode().strip()
+
+
+async def run_git_batch_check(refs: List[str], cwd: Optional[Path] = None) -> List[Optional[str]]:
+    """
+    Resolves several refs to their object name with a single `git cat-file --batch-check`.
+
+    Returns one entry per ref, None for refs git could not resolve.
+    """
+    async with get_git_limiter("cat-file"):
+        proc = await asyncio.create_subprocess_exec(
+            "git",
+            "cat-file",
+            "--batch-check=%(objectname)",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd or None,
+            env=git_env,
+        )
+        stdout, _ = await proc.communicate(("\n".join(refs) + "\n").encode())
+    lines = stdout.decode().splitlines()
+    if proc.returncode != 0 or len(lines) != len(refs):
+        return [None] * len(refs)
+
+    return [None if line.endswith(" missing") or line.endswith(" ambiguous") else line for line in lines]
@@ -0,0 +1,113 @@
+"""Parser-level tests for spec loading."""
+
+from __future__ import annotations
+
+import copy
+import json
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import yaml
+
+from bl.spec_parser import FROZEN_SIDECAR_VERSION, OriginType, RefspecInfo, get_frozen_digest, load_spec_file
+
+
+def test_cached_spec_is_not_shared_between_loads() -> None:
+    """Test that loading the same spec twice returns independent objects."""
+    spec_data = {
+        "queue": {
+            "modules": ["queue_job"],
+            "remotes": {
+                "oca": "https://example.com/OCA/queue",
+            },
+            "merges": ["oca 14.0"],
+        },
+    }
+
+    with TemporaryDirectory() as td:
+        td_path = Path(td)
+        spec_path = td_path / "spec.yaml"
+        spec_path.write_text(yaml.safe_dump(spec_data))
+
+        first = load_spec_file(spec_path, None, td_path)
+        assert first is not None
+        first.specs["queue"].remotes["other"] = "https://example.com/other"
+
+        second = load_spec_file(spec_path, None, td_path)
+        assert second is not None
+        assert second.specs["queue"].remotes == {"oca": "https://example.com/OCA/queue"}
+
+
+def test_spec_reloaded_when_file_changes() -> None:
+    """Test that an edited spec file is parsed again instead of served from cache."""
+    with TemporaryDirectory() as td:
+        td_path = Path(td)
+        spec_path = td_path / "spec.yaml"
+        spec_path.write_text(yaml.safe_dump({"queue": {"modules": ["queue_job"], "merges": []}}))
+
+        first = load_spec_file(spec_path, None, td_path)
+        assert first is not None
+        assert first.specs["queue"].modules == ["queue_job"]
+
+        spec_path.write_text(yaml.safe_dump({"queue": {"modules": ["queue_job", "queue_job_cron"], "merges": []}}))
+
+        second = load_spec_file(spec_path, None, td_path)
+        assert second is not None
+        assert second.specs["queue"].modules == ["queue_job", "queue_job_cron"]
+
+
+def test_frozen_sidecar_ignored_when_yaml_was_edited() -> None:
+    """Test that a hand edited frozen.yaml wins over its JSON sidecar, even with identical file times."""
+    spec_data = {
+        "queue": {
+            "modules": [],
+            "remotes": {
+                "oca": "https://example.com/OCA/queue",
+            },
+            "merges": ["oca 14.0"],
+        },
+    }
+
+    with TemporaryDirectory() as td:
+        td_path = Path(td)
+        spec_path = td_path / "spec.yaml"
+        frozen_path = td_path / "frozen.yaml"
+        sidecar_path = td_path / "frozen.json"
+
+        spec_path.write_text(yaml.safe_dump(spec_data))
+        frozen_content = yaml.safe_dump({"queue": {"oca": {"14.0": "a" * 40}}}).encode()
+        frozen_path.write_bytes(frozen_content)
+        sidecar_path.write_text(
+            json.dumps(
+                {
+                    "version": FROZEN_SIDECAR_VERSION,
+                    "yaml_digest": get_frozen_digest(frozen_content),
+                    # Differs from the YAML file to tell which one was loaded
+                    "frozen": {"queue": {"oca": {"14.0": "c" * 40}}},
+                }
+            )
+        )
+
+        project = load_spec_file(spec_path, frozen_path, td_path)
+        assert project is not None
+        assert project.specs["queue"].refspec_info[0].refspec == "c" * 40
+
+        frozen_path.write_text(yaml.safe_dump({"queue": {"oca": {"14.0": "b" * 40}}}))
+        sidecar_mtime_ns = sidecar_path.stat().st_mtime_ns
+        os.utime(frozen_path, ns=(sidecar_mtime_ns, sidecar_mtime_ns))
+        project = load_spec_file(spec_path, frozen_path, td_path)
+        assert project is not None
+        assert project.specs["queue"].refspec_info[0].refspec == "b" * 40
+
+
+def test_local_ref_names_follow_the_frozen_ref_name() -> None:
+    """Test that a frozen sha keeps the local branch of the ref it freezes."""
+    sha = "a" * 40
+    branch = RefspecInfo("oca", "14.0", OriginType.BRANCH)
+    frozen = RefspecInfo("oca", sha, OriginType.REF, "14.0")
+
+    assert branch.local_ref == "loc-14.0"
+    assert frozen.local_ref == "loc-14.0"
+    assert RefspecInfo("oca", sha, OriginType.REF).local_ref == f"loc-{sha}"
+    assert copy.deepcopy(frozen).local_ref == "loc-14.0"
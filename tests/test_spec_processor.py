@@ -0,0 +1,227 @@
+"""Processor-level tests for helpers that do not need a git repository."""
+
+from __future__ import annotations
+
+import os
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+import yaml
+
+from bl.spec_parser import ModuleSpec, OriginType, RefspecInfo, load_spec_file
+from bl.spec_processor import SpecProcessor, create_cone_sparse_patterns, process_project
+
+
+def _run_git(repo: Path, *args: str) -> str:
+    """Run a git command and return stdout."""
+    result = subprocess.run(["git", *args], cwd=str(repo), check=True, capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def test_cone_sparse_patterns_match_git_layout() -> None:
+    """Test that the sparse-checkout file lists directories like `git sparse-checkout set` does."""
+    patterns = create_cone_sparse_patterns(["x/y/z", "q", "x/w/"]).decode().splitlines()
+
+    assert patterns == ["/*", "!/*/", "/q/", "/x/", "!/x/*/", "/x/w/", "/x/y/", "!/x/y/*/", "/x/y/z/"]
+
+
+def test_local_modules_in_links_are_not_linked() -> None:
+    """Test that directories sitting in links/ are kept as local modules while symlinks are replaced."""
+    with TemporaryDirectory() as td:
+        td_path = Path(td)
+        links_path = td_path / "links"
+        (links_path / "local_module").mkdir(parents=True)
+        os.symlink(td_path, links_path / "linked_module")
+
+        processor = SpecProcessor(td_path)
+        spec = ModuleSpec(["local_module", "linked_module", "new_module"])
+
+        assert processor.filter_non_link_module(spec) == ["linked_module", "new_module"]
+
+
+def _count_processor_calls(monkeypatch: pytest.MonkeyPatch, *method_names: str) -> list:
+    """Records the calls to the given SpecProcessor methods, in order."""
+    calls = []
+
+    def count_calls(method_name: str):
+        method = getattr(SpecProcessor, method_name)
+
+        async def wrapper(self, *args, **kwargs):
+            calls.append(method_name)
+            return await method(self, *args, **kwargs)
+
+        monkeypatch.setattr(SpecProcessor, method_name, wrapper)
+
+    for method_name in method_names:
+        count_calls(method_name)
+    return calls
+
+
+def _create_remote_repo(remote_repo: Path) -> str:
+    """Creates a repo with mod_a on main and a feature branch ahead of it, returns the feature sha."""
+    (remote_repo / "mod_a").mkdir(parents=True)
+    _run_git(remote_repo, "init", "-b", "main")
+    _run_git(remote_repo, "config", "user.name", "Test User")
+    _run_git(remote_repo, "config", "user.email", "test@example.com")
+    (remote_repo / "mod_a" / "file.txt").write_text("first\n")
+    _run_git(remote_repo, "add", ".")
+    _run_git(remote_repo, "commit", "-m", "first")
+    # A descendant of main, so its merge is a fast-forward that needs no committer
+    _run_git(remote_repo, "checkout", "-b", "feature")
+    (remote_repo / "mod_a" / "file.txt").write_text("feature\n")
+    _run_git(remote_repo, "commit", "-am", "feature")
+    return _run_git(remote_repo, "rev-parse", "HEAD")
+
+
+def _write_spec(workdir: Path, remote_repo: Path) -> Path:
+    """Writes a spec merging feature into main for mod_a, returns its path."""
+    workdir.mkdir()
+    spec_path = workdir / "spec.yaml"
+    spec_data = {
+        "test-module": {
+            "modules": ["mod_a"],
+            "remotes": {"origin": remote_repo.as_uri()},
+            "merges": ["origin main", "origin feature"],
+        }
+    }
+    spec_path.write_text(yaml.safe_dump(spec_data))
+    return spec_path
+
+
+async def _process_spec(spec_path: Path, workdir: Path) -> None:
+    project = load_spec_file(spec_path, None, workdir)
+    assert project is not None
+    await process_project(project, concurrency=1)
+
+
+@pytest.mark.asyncio
+async def test_unchanged_module_skips_fetch_and_merge(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a second build against an unchanged remote neither fetches nor merges."""
+    calls = _count_processor_calls(monkeypatch, "resolve_remote_refs", "fetch_module_repo", "merge_module_repo")
+
+    with TemporaryDirectory() as td:
+        td_path = Path(td)
+        remote_repo = td_path / "remote_repo"
+        feature_sha = _create_remote_repo(remote_repo)
+        workdir = td_path / "workdir"
+        spec_path = _write_spec(workdir, remote_repo)
+        module_repo = workdir / "external-src" / "test-module"
+
+        await _process_spec(spec_path, workdir)
+        # Nothing to compare against on a first build, the remote is not queried beforehand
+        assert calls == ["fetch_module_repo", "merge_module_repo"]
+        assert (module_repo / ".git" / "bl-lastsync").is_file()
+        assert _run_git(module_repo, "rev-parse", "HEAD") == feature_sha
+
+        calls.clear()
+        await _process_spec(spec_path, workdir)
+        assert calls == ["resolve_remote_refs"]
+        assert (workdir / "links" / "mod_a" / "file.txt").read_text() == "feature\n"
+
+
+@pytest.mark.asyncio
+async def test_advanced_root_branch_is_fetched_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a new commit on the root branch is built once, then the module is up to date again."""
+    calls = _count_processor_calls(monkeypatch, "resolve_remote_refs", "fetch_module_repo", "merge_module_repo")
+
+    with TemporaryDirectory() as td:
+        td_path = Path(td)
+        remote_repo = td_path / "remote_repo"
+        _create_remote_repo(remote_repo)
+        workdir = td_path / "workdir"
+        spec_path = _write_spec(workdir, remote_repo)
+        module_repo = workdir / "external-src" / "test-module"
+
+        await _process_spec(spec_path, workdir)
+
+        # main moves past feature, merging feature stays a fast-forward
+        _run_git(remote_repo, "checkout", "main")
+        _run_git(remote_repo, "merge", "--ff-only", "feature")
+        (remote_repo / "mod_a" / "file.txt").write_text("second\n")
+        _run_git(remote_repo, "commit", "-am", "second")
+        main_sha = _run_git(remote_repo, "rev-parse", "HEAD")
+
+        calls.clear()
+        await _process_spec(spec_path, workdir)
+        assert calls == ["resolve_remote_refs", "fetch_module_repo", "merge_module_repo"]
+        assert _run_git(module_repo, "rev-parse", "origin/main") == main_sha
+        assert _run_git(module_repo, "rev-parse", "HEAD") == main_sha
+        assert (workdir / "links" / "mod_a" / "file.txt").read_text() == "second\n"
+
+        calls.clear()
+        await _process_spec(spec_path, workdir)
+        assert calls == ["resolve_remote_refs"]
+
+
+@pytest.mark.asyncio
+async def test_mirror_is_updated_once_per_repository(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the https and ssh spellings of a repository share one mirror update."""
+    git_calls = []
+
+    async def fake_run_git(*args, **kwargs):
+        git_calls.append(args)
+        return 1, "", "unreachable"
+
+    monkeypatch.setattr("bl.spec_processor.run_git", fake_run_git)
+
+    with TemporaryDirectory() as td:
+        processor = SpecProcessor(Path(td) / "work", cache_dir=Path(td) / "cache")
+        assert await processor.ensure_mirror("https://github.com/OCA/web.git") is None
+        assert await processor.ensure_mirror("git@github.com:OCA/web") is None
+
+    assert len(git_calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_multi_mirrors_only_branches_outside_odoo(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that remotes are mirrored only for branches, and never for odoo."""
+    mirrored_urls = []
+
+    async def fake_ensure_mirror(self, remote_url):
+        mirrored_urls.append(remote_url)
+        return None
+
+    async def fake_run_git(*args, **kwargs):
+        return 0, "", ""
+
+    monkeypatch.setattr(SpecProcessor, "ensure_mirror", fake_ensure_mirror)
+    monkeypatch.setattr("bl.spec_processor.run_git", fake_run_git)
+
+    branch = RefspecInfo("fork", "17.0", OriginType.BRANCH, None)
+    pull_request = RefspecInfo("fork", "refs/pull/1/head", OriginType.PR, None)
+    url = "https://github.com/fork/repo.git"
+    with TemporaryDirectory() as td:
+        processor = SpecProcessor(Path(td), cache_dir=Path(td) / "cache")
+        await processor.fetch_multi("web", "fork", [pull_request], Path(td), url)
+        await processor.fetch_multi("odoo", "fork", [branch, pull_request], Path(td), url)
+        assert mirrored_urls == []
+
+        await processor.fetch_multi("web", "fork", [branch, pull_request], Path(td), url)
+        assert mirrored_urls == [url]
+
+
+def test_link_all_modules_replaces_only_changed_links() -> None:
+    """Test that relinking keeps correct links in place and fixes the others."""
+    with TemporaryDirectory() as td:
+        workdir = Path(td)
+        module_path = workdir / "external-src" / "repo"
+        links_path = workdir / "links"
+        links_path.mkdir()
+        # A wrong link to fix and a temporary link left over by an interrupted run
+        (links_path / "mod_b").symlink_to("../elsewhere/mod_b")
+        (links_path / f".mod_a.{os.getpid()}.tmp").symlink_to("../elsewhere/mod_a")
+
+        processor = SpecProcessor(workdir)
+        assert processor.link_all_modules(["mod_a", "mod_b"], module_path) == (0, "")
+
+        expected_target = os.path.join("..", "external-src", "repo")
+        for module_name in ("mod_a", "mod_b"):
+            assert os.readlink(links_path / module_name) == os.path.join(expected_target, module_name)
+        assert sorted(os.listdir(links_path)) == ["mod_a", "mod_b"]
+
+        inodes = {name: os.lstat(links_path / name).st_ino for name in ("mod_a", "mod_b")}
+        assert processor.link_all_modules(["mod_a", "mod_b"], module_path) == (0, "")
+        assert {name: os.lstat(links_path / name).st_ino for name in ("mod_a", "mod_b")} == inodes
+        assert sorted(os.listdir(links_path)) == ["mod_a", "mod_b"]